@@ -1,7 +1,10 @@
 """
 Testing for textpipe doc.py
 """
+import gc
 import re
+import weakref
+from collections import Counter
 from unittest import mock
 
 import pytest
@@ -95,6 +98,18 @@ def test_nwords_nsents():
     assert DOC_3.nsents == 0
 
 
+def test_words_soa():
+    texts, offsets = DOC_1.words_soa
+    assert list(zip(texts, offsets.tolist())) == DOC_1.words
+    assert Doc('').words_soa[1].shape == (0,)
+
+
+@mock.patch('textpipe.doc.MIN_VECTORIZED_WORD_COUNTS_LENGTH', 0)
+def test_vectorized_word_counts():
+    doc = Doc(TEXT_1)
+    assert list(doc.word_counts.items()) == list(Counter(word for word, _ in doc.words).items())
+
+
 def test_entities():
     assert sorted(DOC_1.ents) == sorted([('Google', 'ORG')])
     assert sorted(DOC_2.ents) == sorted([('Philips', 'ORG')])
@@ -117,12 +132,34 @@ def test_clean_newlines():
     assert ' '.join(TEXT_4.split()) == DOC_4.clean
 
 
+def test_bytes_raw():
+    assert Doc(TEXT_1.encode('utf-8')).clean == DOC_1.clean
+    assert Doc(memoryview(TEXT_2.encode('utf-8'))).raw == TEXT_2
+
+
+def test_doc_not_kept_alive_by_caches():
+    doc = Doc('Test sentence for testing text')
+    doc.find_ents()
+    assert doc.nwords == 5
+    doc_ref = weakref.ref(doc)
+    del doc
+    gc.collect()
+    assert doc_ref() is None
+
+
 def test_language():
     assert DOC_1.language == 'en'
     assert DOC_2.language == 'nl'
     assert DOC_3.language == 'un'
 
 
+@mock.patch('textpipe.util.cld2.detect')
+def test_language_detection_skipped_for_short_text(detect):
+    assert Doc('Hallo', hint_language='nl').detect_language('nl') == (True, 'nl')
+    assert Doc('!?', hint_language='nl').detect_language('nl') == (False, 'un')
+    detect.assert_not_called()
+
+
 def test_extract_keyterms():
     message = 'ranker "bulthaup" not available; use one of [\'textrank\', \'sgrank\', \'scake\', \'yake\']'
     with pytest.raises(ValueError, match=re.escape(message)):
@@ -179,6 +216,7 @@ def test_gensim_word2vec_with_redis():
     # Load word2vec model into fake Redis
     kv = RedisKeyedVectors('redis://host:1234/0', 'nl')
     kv.load_keyed_vectors_into_redis('tests/models/gensim_test_nl.kv')
+    assert RedisKeyedVectors('redis://host:1234/0', 'nl').dim == 10
 
     expected_doc_2 = [0.0076740906, -0.051765148, -0.008963874, -0.16817021, -0.12640671,
                       -0.28199115, -0.1418166, -0.08547635, -0.1489038, 0.049820565]
@@ -212,6 +250,38 @@ def test_gensim_word2vec_with_redis():
     kv._redis.flushall()
 
 
+@mock.patch('textpipe.wrappers.Redis', FakeRedis)
+def test_redis_word_vector_cache_shared():
+    kv = RedisKeyedVectors('redis://host:1234/0', 'nl')
+    kv.load_keyed_vectors_into_redis('tests/models/gensim_test_nl.kv')
+    other_kv = RedisKeyedVectors('redis://host:1234/0', 'nl')
+
+    vector = kv.word_vec('textmining')
+    assert vector.shape == (10,)
+    assert np.array_equal(other_kv.word_vec('textmining'), vector)
+    assert other_kv._cached_entry.cache_info().hits == 1
+
+    # misses are cached as well
+    assert kv.word_vec('notaword') is None
+    assert other_kv.word_vec('notaword') is None
+    assert kv._cached_entry.cache_info().hits == 2
+
+    other_kv.load_keyed_vectors_into_redis('tests/models/gensim_test_nl.kv')
+    assert kv._cached_entry.cache_info().currsize == 0
+    kv._redis.flushall()
+
+
+@mock.patch('textpipe.wrappers.Redis', FakeRedis)
+def test_gensim_word2vec_with_redis_empty_doc():
+    kv = RedisKeyedVectors('redis://host:1234/0', 'nl')
+    kv.load_keyed_vectors_into_redis('tests/models/gensim_test_nl.kv')
+
+    assert kv[[]].shape == (0, 10)
+    assert Doc('', hint_language='nl', gensim_vectors={'nl': kv}). \
+        generate_gensim_document_embedding(model_uri='redis://host:1234/0') == []
+    kv._redis.flushall()
+
+
 @mock.patch('textpipe.wrappers.Redis', FakeRedis)
 def test_gensim_word2vec_with_redis_no_model():
     with pytest.raises(TextpipeMissingModelException) as e:
@@ -232,3 +302,9 @@ def test_lead():
 
 def test_cats():
     assert DOC_5.get_cats('cats') == {'POSITIVE': 1.0}
+
+
+def test_clean_truncates_long_html():
+    doc = Doc('<p>' + 'a ' * 100 + '</p>', max_html_length=13)
+    assert doc.clean == 'a a a a a'
+    assert Doc('<p>' + 'a ' * 100 + '</p>', max_html_length=None).clean == ' '.join(['a'] * 100)
@@ -2,10 +2,15 @@
 Testing for textpipe pipeline.py
 """
 
+import pickle
 import tempfile
+from unittest import mock
+
 import pytest
 import spacy
 
+import textpipe.operation
+from textpipe.doc import Doc
 from textpipe.pipeline import Pipeline
 
 TEXT = 'Test sentence for testing'
@@ -29,6 +34,7 @@ def test_load_custom_model():
     """
     The custom spacy language modules should be correctly loaded into the pipeline.
     """
+    assert not dict(Pipeline(STEPS, **PIPELINE_DEF_KWARGS)._spacy_nlps['nl'])  # not loaded yet
     assert PIPE._spacy_nlps['nl']['ents'].lang == 'nl'
     assert PIPE._spacy_nlps['en']['other_identifier'].lang == 'en'
 
@@ -163,6 +169,26 @@ def test_register_not_existing_step_should_throw_exception():
     assert "has no attribute 'CUSTOM_STEP2'" in str(ae.value)
 
 
+def test_abstract_operation_is_not_a_step():
+    """
+    Base classes of operations and other attributes of the operation module can't be used as
+    steps, unlike operations added to the module.
+    """
+    with pytest.raises(AttributeError, match="has no attribute 'AttributeOperation'"):
+        Pipeline(['AttributeOperation'])
+    with pytest.raises(AttributeError, match="has no attribute 'TextpipeMissingModelException'"):
+        Pipeline(['TextpipeMissingModelException'])
+
+    class Upper(textpipe.operation.AttributeOperation):
+        attribute = 'clean'
+
+        def __call__(self, doc, **kwargs):
+            return super().__call__(doc).upper()
+
+    with mock.patch('textpipe.operation.Upper', Upper, create=True):
+        assert Pipeline(['Upper'])(TEXT) == {'Upper': TEXT.upper()}
+
+
 def test_gensim_model_caching_in_pipeline():
     """
     Checking whether the pipeline caches the loading of gensim models after a first
@@ -180,3 +206,136 @@ def test_gensim_model_caching_in_pipeline():
     test_pipe(TEXT)
     # Assert that something is in the gensim vectors attribute
     assert len(test_pipe._gensim_vectors) == 1
+
+
+def test_pipe():
+    """
+    Batch processing should give the same results as processing texts one by one.
+    """
+    test_pipe = Pipeline(STEPS, **PIPELINE_DEF_KWARGS)
+    texts = [TEXT, 'Een Nederlandse zin om mee te testen', TEXT]
+
+    assert list(test_pipe.pipe(texts, batch_size=2)) == [test_pipe(text) for text in texts]
+    assert list(test_pipe.pipe(texts, batch_chars=30)) == [test_pipe(text) for text in texts]
+
+
+def test_concurrent_steps():
+    """
+    Running the steps concurrently should give the same results as running them sequentially.
+    """
+    concurrent_pipe = Pipeline(STEPS, max_workers=4, **PIPELINE_DEF_KWARGS)
+
+    assert concurrent_pipe(TEXT) == Pipeline(STEPS, **PIPELINE_DEF_KWARGS)(TEXT)
+    concurrent_pipe.close()
+    assert concurrent_pipe._executor is None
+    assert concurrent_pipe(TEXT) == Pipeline(STEPS, **PIPELINE_DEF_KWARGS)(TEXT)
+
+
+def test_concurrent_steps_parse_once():
+    """
+    Concurrent steps that only need the tokenizer should share a single parse of the text.
+    """
+    concurrent_pipe = Pipeline(['NWords', 'Words', 'WordCounts', 'MinHash'], max_workers=4)
+
+    with mock.patch.object(Doc, 'get_nlp', autospec=True, side_effect=Doc.get_nlp) as get_nlp:
+        concurrent_pipe(Doc(TEXT))
+    assert get_nlp.call_count == 1
+
+
+def test_map():
+    """
+    Processing texts in worker processes should give the same results as processing them here.
+    """
+    test_pipe = Pipeline(STEPS, **PIPELINE_DEF_KWARGS)
+    texts = [TEXT, 'Een Nederlandse zin om mee te testen', TEXT]
+
+    assert list(test_pipe.map(texts, n_process=2)) == [test_pipe(text) for text in texts]
+
+
+def test_map_after_concurrent_call():
+    """
+    Workers shouldn't use the executor of a concurrent pipeline that was called before map.
+    """
+    test_pipe = Pipeline(STEPS, max_workers=2, **PIPELINE_DEF_KWARGS)
+    texts = [TEXT, 'Een Nederlandse zin om mee te testen']
+    expected = [test_pipe(text) for text in texts]
+
+    assert list(test_pipe.map(texts, n_process=2)) == expected
+    assert pickle.loads(pickle.dumps(test_pipe))(TEXT) == expected[0]
+
+
+def test_unused_spacy_components_disabled():
+    """
+    Only the spacy components that the operations need should run, without changing the results.
+    """
+    steps = [('NWords',), ('Entities',), ('NSentences',)]
+    test_pipe = Pipeline(steps)
+    doc = test_pipe._make_doc('Sentence for testing Google text')
+
+    assert doc.disabled_pipes(doc.get_nlp('en')) == ['tagger']
+    assert test_pipe(TEXT) == {name: Pipeline(steps + [('Keyterms',)])(TEXT)[name]
+                               for (name,) in steps}
+
+
+def test_duplicate_steps():
+    """
+    A step that occurs more than once should run once, with the settings of its last occurrence.
+    """
+    with pytest.warns(UserWarning, match='NWords occurs more than once'):
+        test_pipe = Pipeline(['NWords', 'Raw', ('NWords', {'some': 'arg'})])
+
+    assert test_pipe.steps == [('NWords', {'some': 'arg'}), ('Raw', {})]
+    assert list(test_pipe(TEXT)) == ['NWords', 'Raw']
+
+
+def test_result_cache():
+    """
+    Cached results should be the same as uncached ones and not be changed by callers.
+    """
+    test_pipe = Pipeline(STEPS, cache_size=1, **PIPELINE_DEF_KWARGS)
+    expected = Pipeline(STEPS, **PIPELINE_DEF_KWARGS)(TEXT)
+
+    test_pipe(TEXT)['Raw'] = 'changed'
+    assert test_pipe(TEXT) == expected
+    test_pipe('Another test sentence')
+    assert len(test_pipe._results) == 1
+
+
+def test_result_cache_keyed_by_settings():
+    """
+    Results shouldn't be served from the cache after the languages or step settings change.
+    """
+    test_pipe = Pipeline(['Language'], cache_size=10)
+
+    def custom_op(doc, context=None, settings=None, **kwargs):
+        return settings
+
+    test_pipe.register_operation('CUSTOM_STEP', custom_op)
+    test_pipe.steps.append(('CUSTOM_STEP', {'argument': 1}))
+
+    assert test_pipe(TEXT) == {'Language': 'en', 'CUSTOM_STEP': {'argument': 1}}
+    test_pipe.language = 'nl'
+    assert test_pipe(TEXT)['Language'] == 'nl'
+    test_pipe.steps[1] = ('CUSTOM_STEP', {'argument': 2})
+    assert test_pipe(TEXT)['CUSTOM_STEP'] == {'argument': 2}
+
+
+def test_prewarm():
+    """
+    Prewarming should load the custom models without caching a result.
+    """
+    test_pipe = Pipeline(STEPS, cache_size=1, **PIPELINE_DEF_KWARGS)
+    test_pipe.prewarm()
+
+    assert dict(test_pipe._spacy_nlps['nl'])
+    assert not test_pipe._results
+
+
+def test_call_with_doc():
+    """
+    Applying the pipeline to a Doc should give the same results as applying it to its text.
+    """
+    test_pipe = Pipeline(STEPS, **PIPELINE_DEF_KWARGS)
+    doc = Doc(TEXT, spacy_nlps=test_pipe._spacy_nlps)
+
+    assert test_pipe(doc) == test_pipe(TEXT)
@@ -4,14 +4,13 @@ Clean text, make it readable and obtain metadata from it.
 
 import functools
 import re
-import unicodedata
 from collections import Counter
 from urllib.parse import urlparse
 
-import cld2
 import numpy
 import spacy
 import spacy.matcher
+from spacy.attrs import IDX, ORTH
 import textacy
 import textacy.ke
 import textacy.text_utils
@@ -22,7 +21,35 @@ from gensim.summarization.summarizer import summarize
 
 from textpipe.data.emoji import EMOJI_TO_UNICODE_NAME, EMOJI_TO_SENTIMENT
 from textpipe.wrappers import RedisKeyedVectors
-from textpipe.util import getattr_
+from textpipe.util import cached_method, detect_language, getattr_, minhash_permutations
+
+# longer HTML is truncated before parsing, to bound the time spent on a single document
+MAX_HTML_LENGTH = 5000000
+
+# word counts of docs with more tokens than this are computed in numpy on the token ids
+MIN_VECTORIZED_WORD_COUNTS_LENGTH = 10000
+
+# default spacy model per language, languages not listed here use '<lang>_core_news_sm'
+DEFAULT_MODELS = {
+    'en': 'en_core_web_sm',
+    'zh': 'zh_core_web_sm',
+}
+
+# Punctuation normalisation adapted from Blendle cleaner.py
+# https://github.com/blendle/research-summarization/blob/master/enrichers/cleaner.py#L29
+_DOTS = {'…': '...'}
+_QUOTES = {**dict.fromkeys('`‘’‛⸂⸃⸌⸍⸜⸝', "'"), '„': '"', '“': '"'}
+_DOTS_TABLE = str.maketrans(_DOTS)
+_QUOTES_TABLE = str.maketrans(_QUOTES)
+_DOTS_AND_QUOTES_TABLE = str.maketrans({**_DOTS, **_QUOTES})
+_DOUBLE_QUOTES_RE = re.compile(r"''|,,")
+
+
+def _check_float_dtype(dtype):
+    """Raises a ValueError if dtype is given and isn't a floating point type"""
+    if dtype is not None and not numpy.issubdtype(dtype, numpy.floating):
+        raise ValueError(f'dtype "{dtype}" is not a floating point type; vectors would be '
+                         f'truncated')
 
 
 class TextpipeMissingModelException(Exception):
@@ -40,11 +67,14 @@ class Doc:
     metadata from this doc.
 
     Properties:
-    raw: incoming, unedited text
+    raw: incoming, unedited text, utf-8 encoded bytes are decoded when they are first needed
     language: 2-letter code for the language of the text
     is_detected_language: is the language detected or specified beforehand
     is_reliable_language: is the language specified or was it reliably detected
     hint_language: language you expect your text to be
+    max_html_length: HTML is truncated to this number of characters before it is parsed
+    spacy_components: names of the spacy pipeline components to run, None runs all of them
+    spacy_doc: spacy doc already parsed from the cleaned text, see set_spacy_doc
     _spacy_nlps: nested dictionary {lang: {model_id: model}} with loaded spacy language modules
     """
 
@@ -57,16 +87,68 @@ class Doc:
                  language=None,
                  hint_language='en',
                  spacy_nlps=None,
-                 gensim_vectors=None):
-        self.raw = raw
+                 gensim_vectors=None,
+                 max_html_length=MAX_HTML_LENGTH,
+                 spacy_components=None,
+                 spacy_doc=None):
+        self._raw = raw
         self._language = language
         self.hint_language = hint_language
         self._spacy_nlps = spacy_nlps if spacy_nlps is not None else dict()
         self._gensim_vectors = gensim_vectors if gensim_vectors is not None else dict()
+        self._spacy_docs = {}
         self.is_detected_language = language is None
         self._is_reliable_language = True if language else None
         self._text_stats = {}
+        self._sents = None
+        self._words = None
+        self._words_soa = None
+        self._word_counts = None
         self.nr_train_tokens = 0
+        self.max_html_length = max_html_length
+        self.spacy_components = spacy_components
+        if spacy_doc is not None:
+            self.set_spacy_doc(spacy_doc)
+
+    @property
+    def raw(self):
+        """
+        Incoming, unedited text. Text given as utf-8 encoded bytes (or a memoryview of them) is
+        decoded here, so that it isn't copied until an operation needs it. Invalid bytes are
+        replaced.
+
+        >>> from textpipe.doc import Doc
+        >>> Doc('Test sentence'.encode('utf-8')).raw
+        'Test sentence'
+        """
+        if not isinstance(self._raw, str):
+            self._raw = str(self._raw, 'utf-8', 'replace')
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw):
+        """
+        Replaces the text, everything derived from the previous text is computed again
+
+        >>> from textpipe.doc import Doc
+        >>> doc = Doc('Test sentence')
+        >>> doc.nwords
+        2
+        >>> doc.raw = 'Another test sentence'
+        >>> doc.nwords
+        3
+        """
+        self._raw = raw
+        if self.is_detected_language:
+            self._language = None
+            self._is_reliable_language = None
+        vars(self).pop('_method_cache', None)  # see cached_method
+        self._spacy_docs = {}
+        self._text_stats = {}
+        self._sents = None
+        self._words = None
+        self._words_soa = None
+        self._word_counts = None
 
     @property
     def language(self):
@@ -100,7 +182,7 @@ class Doc:
             self._is_reliable_language, self._language = self.detect_language(self.hint_language)
         return self._is_reliable_language
 
-    @functools.lru_cache()
+    @cached_method
     def detect_language(self, hint_language=None):
         """
         Detected the language of a text if no language was provided along with the text
@@ -121,17 +203,7 @@ class Doc:
         >>> Doc('...').detect_language()
         (False, 'un')
         """
-
-        none_utf_chars_removed = ''.join([l for l in self.clean
-                                          if unicodedata.category(l)[0] not in {'M', 'C'}])
-        is_reliable, _, best_guesses = cld2.detect(none_utf_chars_removed,
-                                                   hintLanguage=hint_language,
-                                                   bestEffort=True)
-
-        if not best_guesses or len(best_guesses[0]) != 4 or best_guesses[0][1] == 'un':
-            return False, 'un'
-
-        return is_reliable, best_guesses[0][1]
+        return detect_language(self.clean, hint_language)
 
     @property
     def _spacy_doc(self):
@@ -147,11 +219,57 @@ class Doc:
 
         return self._load_spacy_doc(lang)
 
-    @functools.lru_cache()
     def _load_spacy_doc(self, lang, model_name=None):
         """
         Loads a spacy doc or creates one if necessary
         """
+        if (lang, model_name) not in self._spacy_docs:
+            nlp = self.get_nlp(lang, model_name)
+            self._spacy_docs[(lang, model_name)] = nlp(self.clean_text(),
+                                                       disable=self.disabled_pipes(nlp))
+        return self._spacy_docs[(lang, model_name)]
+
+    def disabled_pipes(self, nlp):
+        """
+        Names of the components of a spacy language module that are not in spacy_components
+
+        >>> from textpipe.doc import Doc
+        >>> doc = Doc('Test sentence for testing text', spacy_components={'parser'})
+        >>> doc.disabled_pipes(doc.get_nlp('en'))
+        ['tagger', 'ner']
+        """
+        if self.spacy_components is None:
+            return []
+        return [name for name in nlp.pipe_names if name not in self.spacy_components]
+
+    def set_spacy_doc(self, spacy_doc, lang=None, model_name=None):
+        """
+        Use an already parsed spacy doc (e.g. from nlp.pipe) instead of parsing the text again.
+        The spacy doc must be created from the cleaned text of this doc, by the language module
+        of lang and model_name (see get_nlp). lang defaults to the language the doc's models are
+        looked up for, which can differ from the spacy doc's lang_ (e.g. for custom models).
+
+        >>> from textpipe.doc import Doc
+        >>> doc = Doc('Test sentence for testing text')
+        >>> spacy_doc = doc.get_nlp('en')(doc.clean)
+        >>> doc.set_spacy_doc(spacy_doc)
+        >>> doc._spacy_doc is spacy_doc
+        True
+        >>> Doc('Test sentence for testing text', spacy_doc=spacy_doc)._spacy_doc is spacy_doc
+        True
+        >>> doc.set_spacy_doc(spacy_doc, 'nl', 'custom')
+        >>> doc._load_spacy_doc('nl', 'custom') is spacy_doc
+        True
+        """
+        if lang is None:
+            lang = self.language if self.is_reliable_language else self.hint_language
+        self._spacy_docs[(lang, model_name)] = spacy_doc
+
+    def get_nlp(self, lang, model_name=None):
+        """
+        Returns the spacy language module for a language and (custom) model name, the default
+        module for the language is loaded if necessary
+        """
         # Load default spacy model if necessary, if not loaded already
         if lang not in self._spacy_nlps or (model_name is None and
                                             model_name not in self._spacy_nlps[lang]):
@@ -161,9 +279,7 @@ class Doc:
         if model_name not in self._spacy_nlps[lang] and model_name is not None:
             raise TextpipeMissingModelException(f'Custom model {model_name} '
                                                 f'is missing.')
-        nlp = self._spacy_nlps[lang][model_name]
-        doc = nlp(self.clean_text())
-        return doc
+        return self._spacy_nlps[lang][model_name]
 
     @staticmethod
     @functools.lru_cache()
@@ -172,7 +288,7 @@ class Doc:
         Loads the spacy default language module for the Doc's language
         """
         try:
-            return spacy.load('{}_core_{}_sm'.format(lang, 'web' if lang == 'en' else 'news'))
+            return spacy.load(DEFAULT_MODELS.get(lang) or f'{lang}_core_news_sm')
         except IOError:
             # pylint: disable=raise-missing-from
             raise TextpipeMissingModelException(f'Default model for language "{lang}" '
@@ -190,7 +306,7 @@ class Doc:
         """
         return self.clean_text()
 
-    @functools.lru_cache()
+    @cached_method
     def clean_text(self, remove_html=True, clean_dots=True, clean_quotes=True,
                    clean_whitespace=True):
         """
@@ -202,18 +318,23 @@ class Doc:
         True
         """
         text = self.raw
-        if remove_html:
+        # the HTML parser returns text without tags or character references unchanged (unless
+        # it consists of whitespace only), so only parse when it can make a difference
+        if remove_html and ('<' in text or '&' in text or text.isspace()):
+            # cap parse time for pathological inputs; None disables truncation
+            text = text[:self.max_html_length]
             text = BeautifulSoup(text, 'html.parser').get_text()  # remove HTML
 
-        # Three regexes below adapted from Blendle cleaner.py
-        # https://github.com/blendle/research-summarization/blob/master/enrichers/cleaner.py#L29
-        if clean_dots:
-            text = re.sub(r'…', '...', text)
-        if clean_quotes:
-            text = re.sub(r'[`‘’‛⸂⸃⸌⸍⸜⸝]', "'", text)
-            text = re.sub(r'[„“]|(\'\')|(,,)', '"', text)
+        # Single character replacements are done in one pass with str.translate, pairs of single
+        # quotes and commas are replaced afterwards
+        if clean_dots and clean_quotes:
+            text = _DOUBLE_QUOTES_RE.sub('"', text.translate(_DOTS_AND_QUOTES_TABLE))
+        elif clean_dots:
+            text = text.translate(_DOTS_TABLE)
+        elif clean_quotes:
+            text = _DOUBLE_QUOTES_RE.sub('"', text.translate(_QUOTES_TABLE))
         if clean_whitespace:
-            text = re.sub(r'\s+', ' ', text).strip()
+            text = ' '.join(text.split())
 
         return text
 
@@ -229,7 +350,7 @@ class Doc:
         """
         return self.find_ents()
 
-    @functools.lru_cache()
+    @cached_method
     def find_ents(self, model_name=None, ent_attributes=('text', 'label_')):
         """
         Extract a list of the named entities in text, with the possibility of using a custom model.
@@ -240,8 +361,9 @@ class Doc:
         [('Google', 'ORG')]
         """
         lang = self.language if self.is_reliable_language else self.hint_language
-        return list({tuple(getattr_(ent, attr) for attr in ent_attributes)
-                     for ent in self._load_spacy_doc(lang, model_name).ents})
+        # dict keys deduplicate like a set, but keep the order in which entities occur
+        return list(dict.fromkeys(tuple(getattr_(ent, attr) for attr in ent_attributes)
+                                  for ent in self._load_spacy_doc(lang, model_name).ents))
 
     def match(self, matcher):
         """
@@ -289,7 +411,7 @@ class Doc:
         >>> doc.nsents
         2
         """
-        return len(list(self._spacy_doc.sents))
+        return len(self.sents)
 
     @property
     def sents(self):
@@ -305,8 +427,9 @@ class Doc:
          ('And another one with, some, punctuation!', 32),
          ('And stuff.', 73)]
         """
-
-        return [(span.text, span.start_char) for span in self._spacy_doc.sents]
+        if self._sents is None:
+            self._sents = [(span.text, span.start_char) for span in self._spacy_doc.sents]
+        return self._sents
 
     @property
     def nwords(self):
@@ -318,7 +441,10 @@ class Doc:
         >>> doc.nwords
         5
         """
-        return len(self.words)
+        if self._words is None:
+            # count the tokens without building the (word, offset) tuples
+            return len(self._spacy_doc)
+        return len(self._words)
 
     @property
     def words(self):
@@ -330,8 +456,28 @@ class Doc:
         >>> doc.words
         [('Test', 0), ('sentence', 5), ('for', 14), ('testing', 18), ('text', 26), ('.', 30)]
         """
+        if self._words is None:
+            self._words = [(token.text, token.idx) for token in self._spacy_doc]
+        return self._words
 
-        return [(token.text, token.idx) for token in self._spacy_doc]
+    @property
+    def words_soa(self):
+        """
+        The words of the text as a list of words and a numpy array of their character offsets,
+        which takes less memory than the (word, offset) tuples of words for long texts
+
+        >>> from textpipe.doc import Doc
+        >>> texts, offsets = Doc('Test sentence for testing text.').words_soa
+        >>> texts
+        ['Test', 'sentence', 'for', 'testing', 'text', '.']
+        >>> offsets
+        array([ 0,  5, 14, 18, 26, 30], dtype=int32)
+        """
+        if self._words_soa is None:
+            spacy_doc = self._spacy_doc
+            self._words_soa = ([token.text for token in spacy_doc],
+                               spacy_doc.to_array(IDX).astype(numpy.int32))
+        return self._words_soa
 
     @property
     def word_counts(self):
@@ -350,8 +496,22 @@ class Doc:
          'testing': 1,
          'vectorisation': 1}
         """
+        if self._word_counts is None:
+            if self._words is None and len(self._spacy_doc) > MIN_VECTORIZED_WORD_COUNTS_LENGTH:
+                self._word_counts = self._count_orths()
+            else:
+                self._word_counts = dict(Counter(word for word, _ in self.words))
+        return self._word_counts
 
-        return dict(Counter(word for word, _ in self.words))
+    def _count_orths(self):
+        """
+        Count words by their spacy token ids, in order of first occurrence like Counter does
+        """
+        strings = self._spacy_doc.vocab.strings
+        orths, first_indices, counts = numpy.unique(self._spacy_doc.to_array(ORTH),
+                                                    return_index=True, return_counts=True)
+        order = numpy.argsort(first_indices)
+        return {strings[int(orth)]: int(count) for orth, count in zip(orths[order], counts[order])}
 
     @property
     def complexity(self):
@@ -402,7 +562,7 @@ class Doc:
 
         raise TextpipeMissingModelException(f'No sentiment model for {self.language}')
 
-    @functools.lru_cache()
+    @cached_method
     def extract_keyterms(self, ranker='textrank', n_terms=10, **kwargs):
         """
         Extract and rank key terms in the document by proxying to
@@ -466,15 +626,15 @@ class Doc:
         """
         return self.find_minhash()
 
-    @functools.lru_cache()
+    @cached_method
     def find_minhash(self, num_perm=128):
         """
         Compute minhash, cached.
         """
         words = self.words
-        doc_hash = MinHash(num_perm=num_perm)
-        for word, _ in words:
-            doc_hash.update(word.encode('utf8'))
+        doc_hash = MinHash(num_perm=num_perm, permutations=minhash_permutations(num_perm))
+        if words:
+            doc_hash.update_batch([word.encode('utf8') for word, _ in words])
         return list(doc_hash.digest())
 
     def similarity(self, other_doc, metric='jaccard', hash_method='minhash'):
@@ -503,13 +663,18 @@ class Doc:
         """
         return self.generate_word_vectors()
 
-    @functools.lru_cache()
-    def generate_word_vectors(self, model_name=None):
+    @cached_method
+    def generate_word_vectors(self, model_name=None, dtype=None):
         """
         Returns word embeddings for the words in the document.
         The default spacy models don't have "true" word vectors
         but only context-sensitive tensors that are within the document.
 
+        Args:
+        model_name: name of a custom spacy model
+        dtype: if given, vectors are numpy arrays of this dtype (e.g. 'float16' to halve their
+               memory at the cost of precision) instead of lists of floats
+
         Returns:
         A dictionary mapping words from the document to a dict with the
         corresponding values of the following variables:
@@ -529,12 +694,20 @@ class Doc:
         96
         >>> doc.word_vectors['Test']['vector_norm'] == doc.word_vectors['sentence']['vector_norm']
         False
-        """
+        >>> doc.generate_word_vectors(dtype='float16')['Test']['vector'].dtype
+        dtype('float16')
+        >>> doc.generate_word_vectors(dtype='int8')
+        Traceback (most recent call last):
+        ...
+        ValueError: dtype "int8" is not a floating point type; vectors would be truncated
+        """
+        _check_float_dtype(dtype)
         lang = self.language if self.is_reliable_language else self.hint_language
         return {token.text: {'has_vector': token.has_vector,
                              'vector_norm': token.vector_norm,
                              'is_oov': token.is_oov,
-                             'vector': token.vector.tolist()}
+                             'vector': (token.vector.tolist() if dtype is None
+                                        else token.vector.astype(dtype))}
                 for token in self._load_spacy_doc(lang, model_name)}
 
     @property
@@ -551,14 +724,16 @@ class Doc:
         """
         return self.aggregate_word_vectors()
 
-    @functools.lru_cache()
+    @cached_method
     def aggregate_word_vectors(self,
                                model_name=None,
                                aggregation='mean',
                                normalize=False,
-                               exclude_oov=False):
+                               exclude_oov=False,
+                               dtype=None):
         """
-        Returns document embeddings based on the words in the document.
+        Returns document embeddings based on the words in the document. The embedding is
+        computed in float32 and returned as a list, or as a numpy array of dtype if it is given.
 
         >>> import numpy
         >>> from textpipe.doc import Doc
@@ -583,7 +758,10 @@ class Doc:
         >>> numpy.array_equiv(doc.aggregate_word_vectors(exclude_oov=False),
         ...                   doc.aggregate_word_vectors(exclude_oov=True))
         False
+        >>> doc.aggregate_word_vectors(dtype='float16').dtype
+        dtype('float16')
         """
+        _check_float_dtype(dtype)
         lang = self.language if self.is_reliable_language else self.hint_language
         tokens = [token for token in self._load_spacy_doc(lang, model_name)
                   if not exclude_oov or not token.is_oov]
@@ -591,15 +769,15 @@ class Doc:
                    for token in tokens]
 
         if aggregation == 'mean':
-            return numpy.mean(vectors, axis=0).tolist()
-
-        if aggregation == 'sum':
-            return numpy.sum(vectors, axis=0).tolist()
-
-        if aggregation == 'var':
-            return numpy.var(vectors, axis=0).tolist()
+            aggregated = numpy.mean(vectors, axis=0)
+        elif aggregation == 'sum':
+            aggregated = numpy.sum(vectors, axis=0)
+        elif aggregation == 'var':
+            aggregated = numpy.var(vectors, axis=0)
+        else:
+            raise NotImplementedError(f'Aggregation method {aggregation} is not implemented.')
 
-        raise NotImplementedError(f'Aggregation method {aggregation} is not implemented.')
+        return aggregated.tolist() if dtype is None else aggregated.astype(dtype)
 
     def _load_gensim_word2vec_model(self,
                                     model_uri=None,
@@ -638,7 +816,7 @@ class Doc:
             self._gensim_vectors[lang] = vectors
         return self._gensim_vectors[lang]
 
-    @functools.lru_cache()
+    @cached_method
     def generate_gensim_document_embedding(self,
                                            model_uri=None,
                                            lowercase=True,
@@ -667,18 +845,16 @@ class Doc:
         model = self._load_gensim_word2vec_model(model_uri,
                                                  max_lru_cache_size)
 
-        if lowercase:
-            prepared_word_counts = [(word.lower(), count)
-                                    for word, count in self.word_counts.items()
-                                    if word.lower() in model]
-        else:
-            prepared_word_counts = [(word, count) for word, count in self.word_counts.items()
-                                    if word in model]
-
-        if not prepared_word_counts:
-            return []
+        word_counts = [(word.lower() if lowercase else word, count)
+                       for word, count in self.word_counts.items()]
 
         if isinstance(model, RedisKeyedVectors):
+            # retrieve all vectors in a single request, words that are not in redis get None
+            word_vectors = model.get_vectors([word for word, _ in word_counts])
+            vectors = [vector * count for vector, (_, count) in zip(word_vectors, word_counts)
+                       if vector is not None]
+            if not vectors:
+                return []
             # For redis, the word vectors are already divided by the idf when a word2vec model
             # was loaded (see RedisKeyedVectors.load_keyed_vectors_into_redis)
             if model.idf_weighting != idf_weighting:
@@ -686,9 +862,10 @@ class Doc:
                                                          f'weighting "{idf_weighting}" does not '
                                                          f'match weighting in RedisKeyedVector "'
                                                          f'{model.idf_weighting}"')
-            vectors = [model[word] * count
-                       for word, count in prepared_word_counts]
         else:
+            prepared_word_counts = [(word, count) for word, count in word_counts if word in model]
+            if not prepared_word_counts:
+                return []
             vectors = []
             for word, count in prepared_word_counts:
                 if idf_weighting == 'naive':
@@ -702,7 +879,7 @@ class Doc:
                 vectors.append(model[word] * (count / idf))
         return list(sum(vectors))
 
-    @functools.lru_cache()
+    @cached_method
     def generate_textrank_summary(self, ratio=0.2, word_count=None):
         """
         returns a textrank summary of the document (extractive summary) generated with gensim
@@ -787,7 +964,7 @@ class Doc:
         """
         return self.get_cats()
 
-    @functools.lru_cache()
+    @cached_method
     def get_cats(self, model_name=None):
         """
         Extract a dict of categories and their probability in the text, with the possibility
@@ -10,12 +10,32 @@ so that users do not have to put their Operation classes inside of this module.
 """
 from textpipe.doc import TextpipeMissingModelException
 
+# operation classes of this module by name, see Operation.__init_subclass__
+OPERATIONS = {}
+
 
 class Operation:
     """
     Base class for pipeline operations.
     """
+    __slots__ = ('kwargs',)
     model_mapping = {}
+    # names of the spacy pipeline components the operation needs, None if it may need all of them
+    # (an empty set still needs the tokenizer)
+    spacy_components = None
+    # False if the operation doesn't use spacy at all
+    uses_spacy = True
+    # abstract operations are base classes that can't be used as a step of a pipeline
+    abstract = True
+
+    def __init_subclass__(cls, abstract=False, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.abstract = abstract
+        if cls.__module__ == __name__ and not abstract:
+            OPERATIONS[cls.__name__] = cls
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
 
     def __call__(self, doc, **kwargs):
         raise NotImplementedError()
@@ -33,7 +53,18 @@ class Operation:
         return model
 
 
-class Language(Operation):
+class AttributeOperation(Operation, abstract=True):
+    """
+    Base class for operations that return a single attribute of the doc.
+    """
+    __slots__ = ()
+    attribute = None
+
+    def __call__(self, doc, **kwargs):
+        return getattr(doc, self.attribute)
+
+
+class Language(AttributeOperation):
     """
     Extract the language from a text
 
@@ -42,15 +73,13 @@ class Language(Operation):
     >>> Language()(doc)
     'en'
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.language
+    __slots__ = ()
+    attribute = 'language'
+    spacy_components = frozenset()
+    uses_spacy = False
 
 
-class CleanText(Operation):
+class CleanText(AttributeOperation):
     """
     Clean HTML and normalise punctuation.
 
@@ -59,15 +88,13 @@ class CleanText(Operation):
     >>> CleanText()(doc)
     '"Please clean this piece... of text"'
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.clean
+    __slots__ = ()
+    attribute = 'clean'
+    spacy_components = frozenset()
+    uses_spacy = False
 
 
-class Raw(Operation):
+class Raw(AttributeOperation):
     """
     Extract the number of words from text
 
@@ -76,15 +103,13 @@ class Raw(Operation):
     >>> Raw()(doc)
     'Test sentence for testing text'
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.raw
+    __slots__ = ()
+    attribute = 'raw'
+    spacy_components = frozenset()
+    uses_spacy = False
 
 
-class NWords(Operation):
+class NWords(AttributeOperation):
     """
     Extract the number of words from text
 
@@ -93,32 +118,35 @@ class NWords(Operation):
     >>> NWords()(doc)
     5
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.nwords
+    __slots__ = ()
+    attribute = 'nwords'
+    spacy_components = frozenset()
 
 
 class Words(Operation):
     """
-    Extract words from text
+    Extract words from text, as (word, offset) tuples or with soa=True as a list of words and
+    an array of their offsets
 
     >>> from textpipe.doc import Doc
     >>> doc = Doc('Test sentence for testing text')
     >>> Words()(doc)
     [('Test', 0), ('sentence', 5), ('for', 14), ('testing', 18), ('text', 26)]
+    >>> Words(soa=True)(doc)
+    (['Test', 'sentence', 'for', 'testing', 'text'], array([ 0,  5, 14, 18, 26], dtype=int32))
     """
+    __slots__ = ('soa',)
+    spacy_components = frozenset()
 
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
+    def __init__(self, soa=False, **kwargs):
+        super().__init__(**kwargs)
+        self.soa = soa
 
     def __call__(self, doc, **kwargs):
-        return doc.words
+        return doc.words_soa if self.soa else doc.words
 
 
-class WordCounts(Operation):
+class WordCounts(AttributeOperation):
     """
     Extract words with their counts
 
@@ -135,15 +163,12 @@ class WordCounts(Operation):
       'testing': 1,
       'vectorisation': 1}
     """
+    __slots__ = ()
+    attribute = 'word_counts'
+    spacy_components = frozenset()
 
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
 
-    def __call__(self, doc, **kwargs):
-        return doc.word_counts
-
-
-class Complexity(Operation):
+class Complexity(AttributeOperation):
     """
     Determine the complexity of text using the Flesch
     reading ease test ranging from 0.0 - 100.0 with 0.0
@@ -154,15 +179,12 @@ class Complexity(Operation):
     >>> Complexity()(doc)
     83.32000000000004
     """
+    __slots__ = ()
+    attribute = 'complexity'
+    spacy_components = frozenset({'parser'})
 
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
 
-    def __call__(self, doc, **kwargs):
-        return doc.complexity
-
-
-class Sentences(Operation):
+class Sentences(AttributeOperation):
     """
     Extract sentences from text
 
@@ -175,15 +197,12 @@ class Sentences(Operation):
      ('And another one with, some, punctuation!', 32),
      ('And stuff.', 73)]
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.sents
+    __slots__ = ()
+    attribute = 'sents'
+    spacy_components = frozenset({'parser'})
 
 
-class NSentences(Operation):
+class NSentences(AttributeOperation):
     """
     Extract the number of sentences from text
 
@@ -192,12 +211,9 @@ class NSentences(Operation):
     >>> NSentences()(doc)
     1
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.nsents
+    __slots__ = ()
+    attribute = 'nsents'
+    spacy_components = frozenset({'parser'})
 
 
 class Entities(Operation):
@@ -209,12 +225,23 @@ class Entities(Operation):
     >>> Entities()(doc)
     [('Google', 'ORG')]
     """
+    __slots__ = ('model_mapping', 'ent_attributes')
 
     def __init__(self, model_mapping=None, ent_attributes=('text', 'label_'), **kwargs):
-        self.kwargs = kwargs
+        super().__init__(**kwargs)
         self.model_mapping = model_mapping
         self.ent_attributes = ent_attributes
 
+    @property
+    def spacy_components(self):
+        """
+        Only the entity recognizer, unless custom models or other entity attributes are used
+        that may depend on any component
+        """
+        if self.model_mapping or not set(self.ent_attributes or ()) <= {'text', 'label_'}:
+            return None
+        return frozenset({'ner'})
+
     def __call__(self, doc, **kwargs):
         if not self.model_mapping:
             if not self.ent_attributes:
@@ -224,7 +251,7 @@ class Entities(Operation):
         return doc.find_ents(model_name=self.get_model(doc), ent_attributes=self.ent_attributes)
 
 
-class Sentiment(Operation):
+class Sentiment(AttributeOperation):
     """
     Returns polarity score (-1 to 1) and a subjectivity score (0 to 1)
 
@@ -235,12 +262,10 @@ class Sentiment(Operation):
     >>> Sentiment()(doc)
     (0.9599999999999999, 1.0)
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-
-    def __call__(self, doc, **kwargs):
-        return doc.sentiment
+    __slots__ = ()
+    attribute = 'sentiment'
+    spacy_components = frozenset()
+    uses_spacy = False
 
 
 class Keyterms(Operation):
@@ -262,9 +287,7 @@ class Keyterms(Operation):
      ('Netherlands', 0.22636566128805719),
      ('Amsterdam', 0.20976323737964653)]
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
+    __slots__ = ()
 
     def __call__(self, doc, **kwargs):
         return doc.extract_keyterms(**self.kwargs)
@@ -281,9 +304,11 @@ class MinHash(Operation):
     >>> doc.minhash[:5]
     [407326892, 814360600, 1099082245, 1176349439, 1735256]
     """
+    __slots__ = ('num_perm',)
+    spacy_components = frozenset()
 
     def __init__(self, num_perm=128, **kwargs):
-        self.kwargs = kwargs
+        super().__init__(**kwargs)
         self.num_perm = num_perm
 
     def __call__(self, doc, **kwargs):
@@ -298,23 +323,30 @@ class WordVectors(Operation):
         'has_vector': True if the word has a vector
         'vector_norm': The vector norm of the word
         'is_oov': True if the word is out of vocabulary
-        'vector': The vector corresponding to the word
+        'vector': The vector corresponding to the word, a list of floats or a numpy array of
+                  dtype if it is given (e.g. 'float16' halves the memory of the vectors)
 
     >>> from textpipe.doc import Doc
     >>> doc = Doc('Sentence for vectorization')
     >>> WordVectors()(doc)['Sentence']['has_vector']
     True
+    >>> WordVectors(dtype='float16')(doc)['Sentence']['vector'].dtype
+    dtype('float16')
     """
+    __slots__ = ('model_mapping', 'dtype')
 
-    def __init__(self, model_mapping=None, **kwargs):
+    def __init__(self, model_mapping=None, dtype=None, **kwargs):
+        super().__init__(**kwargs)
         self.model_mapping = model_mapping
-        self.kwargs = kwargs
+        self.dtype = dtype
 
     def __call__(self, doc, **kwargs):
         if not self.model_mapping:
-            return doc.word_vectors
+            if self.dtype is None:
+                return doc.word_vectors
+            return doc.generate_word_vectors(dtype=self.dtype)
 
-        return doc.generate_word_vectors(self.get_model(doc))
+        return doc.generate_word_vectors(self.get_model(doc), dtype=self.dtype)
 
 
 class DocumentVector(Operation):
@@ -325,11 +357,14 @@ class DocumentVector(Operation):
     >>> doc = Doc('Sentence for vectorization')
     >>> len(DocumentVector()(doc))
     96
+    >>> DocumentVector(dtype='float16')(doc).dtype
+    dtype('float16')
     """
+    __slots__ = ('model_mapping',)
 
     def __init__(self, model_mapping=None, **kwargs):
+        super().__init__(**kwargs)
         self.model_mapping = model_mapping
-        self.kwargs = kwargs
 
     def __call__(self, doc, **kwargs):
         if not self.model_mapping:
@@ -342,13 +377,16 @@ class GensimDocumentEmbedding(Operation):
     """
     Extract a document embedding vector derived from Gensim word embeddings
     """
+    __slots__ = ('model_mapping', 'lowercase', 'max_lru_cache_size', 'idf_weighting')
+    spacy_components = frozenset()
+
     def __init__(self, model_mapping=None, lowercase=True,
                  max_lru_cache_size=1024, idf_weighting='naive', **kwargs):
+        super().__init__(**kwargs)
         self.model_mapping = model_mapping
         self.lowercase = lowercase
         self.max_lru_cache_size = max_lru_cache_size
         self.idf_weighting = idf_weighting
-        self.kwargs = kwargs
 
     def __call__(self, doc, **kwargs):
         return doc.generate_gensim_document_embedding(self.get_model(doc),
@@ -397,9 +435,8 @@ class GensimTextRank(Operation):
     >>> GensimTextRank(word_count=10)(doc)
     []
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
+    __slots__ = ()
+    spacy_components = frozenset()
 
     def __call__(self, doc, **kwargs):
         return doc.generate_textrank_summary(**self.kwargs)
@@ -419,9 +456,8 @@ class LeadSentences(Operation):
     >>> LeadSentences(nsents=2)(doc)
     ['Rice Pudding - Poem by Alan Alexander Milne.', 'What is the matter with Mary Jane?']
     """
-
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
+    __slots__ = ()
+    spacy_components = frozenset({'parser'})
 
     def __call__(self, doc, **kwargs):
         return doc.extract_lead(**self.kwargs)
@@ -436,10 +472,11 @@ class Categories(Operation):
     >>> Categories()(doc)
     {}
     """
+    __slots__ = ('model_mapping',)
 
     def __init__(self, model_mapping=None, **kwargs):
+        super().__init__(**kwargs)
         self.model_mapping = model_mapping
-        self.kwargs = kwargs
 
     def __call__(self, doc, **kwargs):
         if not self.model_mapping:
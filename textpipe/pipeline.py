@@ -1,13 +1,92 @@
 """
 Obtain elements from a textpipe doc, by specifying a pipeline, in a dictionary.
 """
+import copy
+import functools
 import json
+import multiprocessing
+import os
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import spacy
 
-from textpipe.doc import Doc
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from textpipe.doc import Doc, TextpipeMissingModelException
 import textpipe.operation
 
+# pipeline used by the worker processes of Pipeline.map
+_WORKER_PIPELINE = None
+
+
+def _init_worker(pipeline):
+    global _WORKER_PIPELINE  # pylint: disable=global-statement
+    # a forked worker inherits the executor of the pipeline, but not its threads
+    pipeline._executor = None  # pylint: disable=protected-access
+    _WORKER_PIPELINE = pipeline
+
+
+def _apply_in_worker(raw):
+    return _WORKER_PIPELINE(raw)
+
+
+class _LazyModels(dict):
+    """
+    Custom spacy language modules of one language by model name, which are loaded from their
+    paths when they are first used
+    """
+    def __init__(self):
+        super().__init__()
+        self.paths = {}
+
+    def __missing__(self, model_name):
+        model = self[model_name] = spacy.load(self.paths[model_name])
+        return model
+
+    def __contains__(self, model_name):
+        return super().__contains__(model_name) or model_name in self.paths
+
+    def load_all(self):
+        """Loads the models that haven't been used yet"""
+        for model_name in self.paths:
+            self[model_name]  # pylint: disable=pointless-statement
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_operation(oper_cls):
+    """Instance of an operation class without arguments, which all pipelines can share"""
+    return oper_cls()
+
+
+def _dump_json(obj, filename):
+    """Writes obj as json to filename, with orjson if it is installed"""
+    if orjson:
+        with open(filename, 'wb') as json_file:
+            json_file.write(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(filename, 'w') as json_file:
+            json.dump(obj, json_file)
+
+
+def _load_json(filename):
+    """Reads json from filename, with orjson if it is installed"""
+    if orjson:
+        with open(filename, 'rb') as json_file:
+            return orjson.loads(json_file.read())
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+@functools.lru_cache(maxsize=128)
+def _load_json_cached(filename, mtime_ns, size):  # pylint: disable=unused-argument
+    """Reads json from filename, cached until the modification time or size of the file changes"""
+    return _load_json(filename)
+
 
 class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-locals
     """
@@ -17,7 +96,13 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
     >>> sorted(pipe('Test sentence <a=>').items())
     [('CleanText', 'Test sentence'), ('NWords', 2), ('Raw', 'Test sentence <a=>')]
     """
-    def __init__(self, steps, language=None, hint_language=None, models=None, **kwargs):
+    # the public attributes are saved, see to_dict
+    __slots__ = ('language', 'hint_language', 'max_workers', 'cache_size', 'kwargs', 'steps',
+                 '_results', '_executor', '_spacy_nlps', '_gensim_vectors', '_operations',
+                 '_spacy_components')
+
+    def __init__(self, steps, language=None, hint_language=None, models=None, max_workers=1,
+                 cache_size=0, **kwargs):
         """
         Initialize a Pipeline instance
 
@@ -25,10 +110,20 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
         steps: list with strings and/or (operation_name, operation_kwargs)-tuples
         language: 2-letter code for the language of the text
         hint_language: language you expect your text to be
-        models: list of (model_name, lang, model_path)-tuples to load custom spacy language modules
+        models: list of (model_name, lang, model_path)-tuples of custom spacy language modules,
+                which are loaded when they are first used
+        max_workers: number of threads used to run the steps of a single call; with more than one
+                     worker, steps run concurrently and can't read each other's results from context
+        cache_size: number of results of calls that are cached by their raw text (and the
+                    languages and steps), 0 disables the cache; results are copied, so changing
+                    them doesn't change the cache
         """
         self.language = language
         self.hint_language = hint_language
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._results = OrderedDict()
+        self._executor = None
         self._spacy_nlps = {}
         self._gensim_vectors = {}
         self.kwargs = kwargs
@@ -44,40 +139,261 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
                 oper_name = oper[0]
                 oper_kwargs = oper[1] if len(oper) > 1 else {}
 
-            self.steps.append((oper_name, oper_kwargs))
+            if oper_name in self._operations:
+                # results are stored by step name, so only the last occurrence of a step would
+                # show up in the result: run it once, in the place of its first occurrence
+                warnings.warn(f'Step {oper_name} occurs more than once in the pipeline, only '
+                              f'its last occurrence is used')
+                step_names = [step_name for step_name, _ in self.steps]
+                self.steps[step_names.index(oper_name)] = (oper_name, oper_kwargs)
+            else:
+                self.steps.append((oper_name, oper_kwargs))
+
+            try:
+                oper_cls = textpipe.operation.OPERATIONS[oper_name]
+            except KeyError:
+                # operations added to textpipe.operation by other modules aren't registered
+                oper_cls = getattr(textpipe.operation, oper_name, None)
+                if not (isinstance(oper_cls, type)
+                        and issubclass(oper_cls, textpipe.operation.Operation)
+                        and not oper_cls.abstract):
+                    # pylint: disable=raise-missing-from
+                    raise AttributeError(f"module 'textpipe.operation' has no attribute "
+                                         f"'{oper_name}'")
 
-            oper_cls = getattr(textpipe.operation, oper_name)
+            # initialize the target class with the given kwargs, operations without kwargs hold
+            # no state of their own and are shared
+            self._operations[oper_name] = (oper_cls(**oper_kwargs) if oper_kwargs
+                                           else _shared_operation(oper_cls))
 
-            # initialize the target class with the given kwargs
-            self._operations[oper_name] = oper_cls(**oper_kwargs)
+        self._spacy_components = self._needed_spacy_components()
 
-        # loop over model paths and load custom models into _spacy_nlp
+        # loop over model paths and register custom models in _spacy_nlp, loading them is
+        # deferred until a doc needs them
         if models:
             for model_name, lang, model_path in models:
                 if lang not in self._spacy_nlps:
-                    self._spacy_nlps[lang] = {}
-                model = spacy.load(model_path)
-                self._spacy_nlps[lang][model_name] = model
+                    self._spacy_nlps[lang] = _LazyModels()
+                self._spacy_nlps[lang].paths[model_name] = model_path
+
+    def __getstate__(self):
+        # the threads of the executor can't be pickled, a copy starts its own executor
+        state = {slot: getattr(self, slot) for slot in self.__slots__}
+        state['_executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
     def __call__(self, raw):
         """
         Apply the pipeline to raw text. A dictionary containing the requested elements as keys
         and their content is returned
 
+        An existing Doc can be passed instead of raw text, to reuse its parse when several
+        pipelines process the same text; its language and models are used as they are, and its
+        results are not cached. A Doc made by a pipeline only has the spacy components that
+        pipeline needs (see Operation.spacy_components).
+
         Args:
-        raw: incoming, unedited text
+        raw: incoming, unedited text, as str or as utf-8 encoded bytes, or a Doc
+
+        >>> doc = Doc('Test sentence')
+        >>> Pipeline(['NWords'])(doc), Pipeline(['Raw'])(doc)
+        ({'NWords': 2}, {'Raw': 'Test sentence'})
+        """
+        if isinstance(raw, Doc):
+            return self._apply(raw)
+
+        if not self.cache_size or not isinstance(raw, (str, bytes)):
+            return self._apply(self._make_doc(raw))
+
+        # the languages and steps can be changed after the pipeline is created, so they are part
+        # of the key, the settings of the steps in a hashable form
+        key = (raw, self.language, self.hint_language,
+               json.dumps(self.steps, sort_keys=True, default=repr))
+        try:
+            data = self._results[key]
+            self._results.move_to_end(key)
+        except KeyError:
+            data = self._apply(self._make_doc(raw))
+            self._results[key] = data
+            if len(self._results) > self.cache_size:
+                try:
+                    self._results.popitem(last=False)  # evict the least recently used result
+                except KeyError:  # emptied by another thread
+                    pass
+
+        return copy.deepcopy(data)
+
+    def pipe(self, raws, batch_size=128, n_process=1, batch_chars=200000):
+        """
+        Apply the pipeline to an iterable of raw texts and yield a dictionary per text. The
+        texts are parsed by spacy in batches (see spacy's Language.pipe) instead of one by one.
+
+        The texts are consumed lazily: they are buffered until the buffer holds batch_chars
+        characters, after which the buffer is processed and its results are yielded. Note that
+        with n_process > 1 spacy starts new processes for every buffer, so use a large
+        batch_chars in that case.
+
+        Args:
+        raws: iterable of incoming, unedited texts
+        batch_size: number of texts spacy processes per batch
+        n_process: number of processes spacy uses for parsing
+        batch_chars: number of characters buffered before they are processed
+
+        >>> pipe = Pipeline(['NWords'])
+        >>> list(pipe.pipe(['Test sentence', 'Another test sentence']))
+        [{'NWords': 2}, {'NWords': 3}]
         """
-        doc = Doc(raw, language=self.language, hint_language=self.hint_language,
-                  spacy_nlps=self._spacy_nlps, gensim_vectors=self._gensim_vectors)
+        docs, nchars = [], 0
+        for raw in raws:
+            docs.append(self._make_doc(raw))
+            nchars += len(raw)
+            if nchars >= batch_chars:
+                yield from self._pipe_docs(docs, batch_size, n_process)
+                docs, nchars = [], 0
+
+        yield from self._pipe_docs(docs, batch_size, n_process)
+
+    def _pipe_docs(self, docs, batch_size, n_process):
+        # spacy models are language specific, so group the docs by the language of their model
+        docs_per_lang = {}
+        for doc in docs:
+            lang = doc.language if doc.is_reliable_language else doc.hint_language
+            docs_per_lang.setdefault(lang, []).append(doc)
+
+        for lang, lang_docs in docs_per_lang.items():
+            try:
+                nlp = lang_docs[0].get_nlp(lang)
+            except TextpipeMissingModelException:
+                # leave these docs unparsed, operations that need spacy raise like in __call__
+                continue
+            spacy_docs = nlp.pipe((doc.clean for doc in lang_docs), batch_size=batch_size,
+                                  n_process=n_process, disable=lang_docs[0].disabled_pipes(nlp))
+            for doc, spacy_doc in zip(lang_docs, spacy_docs):
+                doc.set_spacy_doc(spacy_doc, lang)
+
+        for doc in docs:
+            yield self._apply(doc)
+
+    def map(self, raws, n_process=None, chunksize=16):
+        """
+        Apply the pipeline to an iterable of raw texts in a pool of worker processes and yield
+        a dictionary per text, in the order of the texts.
+
+        The default spacy model for the pipeline's language and the custom models are loaded
+        before the workers are started, so on platforms that fork the workers share them with
+        this process instead of each loading their own copy.
+
+        Args:
+        raws: iterable of incoming, unedited texts
+        n_process: number of worker processes, defaults to the number of CPUs
+        chunksize: number of texts sent to a worker at once
+
+        >>> pipe = Pipeline(['NWords'])
+        >>> list(pipe.map(['Test sentence', 'Another test sentence'], n_process=2))
+        [{'NWords': 2}, {'NWords': 3}]
+        """
+        self._load_models()
+
+        with multiprocessing.Pool(n_process, initializer=_init_worker, initargs=(self,)) as pool:
+            yield from pool.imap(_apply_in_worker, raws, chunksize)
+
+    def prewarm(self, sample_text='The quick brown fox jumps over the lazy dog.'):
+        """
+        Loads the spacy models of the pipeline and applies it to sample_text, so that the lazy
+        loading and first-call allocations don't slow down the first real call. Call it when a
+        worker starts, before it serves requests. The result is not cached.
+
+        Args:
+        sample_text: text in the language(s) the pipeline will process
+
+        >>> pipe = Pipeline(['NWords'], cache_size=1)
+        >>> pipe.prewarm()
+        >>> len(pipe._results)
+        0
+        """
+        self._load_models()
+        self._apply(self._make_doc(sample_text))
+
+    def _load_models(self):
+        """Loads the default spacy model of the pipeline's language and all custom models"""
+        lang = self.language or self.hint_language
+        if lang:
+            try:
+                self._make_doc('').get_nlp(lang)
+            except TextpipeMissingModelException:
+                pass
+        for lang_models in self._spacy_nlps.values():
+            if isinstance(lang_models, _LazyModels):
+                lang_models.load_all()
+
+    def _make_doc(self, raw):
+        return Doc(raw, language=self.language, hint_language=self.hint_language,
+                   spacy_nlps=self._spacy_nlps, gensim_vectors=self._gensim_vectors,
+                   spacy_components=self._spacy_components)
+
+    def _needed_spacy_components(self):
+        """
+        Union of the spacy components needed by the operations, None if any may need all of them
+
+        >>> sorted(Pipeline(['NWords', 'Entities', 'NSentences'])._needed_spacy_components())
+        ['ner', 'parser']
+        >>> Pipeline(['NWords', 'Keyterms'])._needed_spacy_components() is None
+        True
+        """
+        components = set()
+        for operation in self._operations.values():
+            needed = getattr(operation, 'spacy_components', None)
+            if needed is None:
+                return None
+            components.update(needed)
+        return frozenset(components)
+
+    def _apply(self, doc):
+        if self.max_workers > 1:
+            return self._apply_concurrently(doc)
 
         data = {}
+        operations = self._operations
 
         for oper, settings in self.steps:
-            target_operation = self._operations[oper]
-            data[oper] = target_operation(doc, context=data, settings=settings)
+            data[oper] = operations[oper](doc, context=data, settings=settings)
 
         return data
 
+    def _apply_concurrently(self, doc):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # parse once up front, rather than in whichever operations happen to run first, unless
+        # none of the operations use spacy
+        if any(getattr(self._operations[oper], 'uses_spacy', True) for oper, _ in self.steps):
+            try:
+                doc._spacy_doc  # pylint: disable=pointless-statement,protected-access
+            except TextpipeMissingModelException:
+                pass
+
+        futures = [(oper, self._executor.submit(self._operations[oper], doc, context={},
+                                                settings=settings))
+                   for oper, settings in self.steps]
+
+        return {oper: future.result() for oper, future in futures}
+
+    def close(self):
+        """
+        Stops the threads that run the steps of a pipeline with max_workers > 1. The pipeline
+        can still be used afterwards, it starts new threads when it is called again.
+        """
+        executor, self._executor = getattr(self, '_executor', None), None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def __del__(self):
+        self.close()
+
     def register_operation(self, op_name, target_fn):
         """
         Extends the available operations with the given name and callable target function
@@ -87,6 +403,8 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
         :return:
         """
         self._operations[op_name] = target_fn
+        self._results.clear()
+        self._spacy_components = self._needed_spacy_components()
 
     def save(self, filename):
         """ # pylint: disable=line-too-long
@@ -99,13 +417,10 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
         >>> fp = tempfile.NamedTemporaryFile()
         >>> Pipeline(['NSentences', ('CleanText', {'some': 'arg'})]).save(fp.name)
         >>> sorted(json.load(fp).items())
-        [('hint_language', None), ('kwargs', {}), ('language', None), ('steps', [['NSentences', {}], ['CleanText', {'some': 'arg'}]])]
+        [('cache_size', 0), ('hint_language', None), ('kwargs', {}), ('language', None), ('max_workers', 1), ('steps', [['NSentences', {}], ['CleanText', {'some': 'arg'}]])]
         >>> fp.close()
         """
-        with open(filename, 'w') as json_file:
-            # serialize all public attrs
-            serialize = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
-            json.dump(serialize, json_file)
+        _dump_json(self.to_dict(), filename)
 
     @staticmethod
     def load(filename):
@@ -120,13 +435,23 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
         >>> Pipeline(['NSentences', ('CleanText', {'some': 'arg'})]).save(fp.name)
         >>> p = Pipeline.load(fp.name)
         >>> fp.close()
-        >>> public_flds = dict(filter(lambda i: not i[0].startswith('_'), p.__dict__.items()))
-        >>> sorted(public_flds.items())
-        [('hint_language', None), ('kwargs', {}), ('language', None), ('steps', [('NSentences', {}), ('CleanText', {'some': 'arg'})])]
+        >>> sorted(p.to_dict().items())
+        [('cache_size', 0), ('hint_language', None), ('kwargs', {}), ('language', None), ('max_workers', 1), ('steps', [('NSentences', {}), ('CleanText', {'some': 'arg'})])]
+        """
+        stat = os.stat(filename)
+        # from_dict changes the dict it is given, so don't hand it the cached one
+        dict_representation = _load_json_cached(filename, stat.st_mtime_ns, stat.st_size)
+        return Pipeline.from_dict(copy.deepcopy(dict_representation))
+
+    def to_dict(self):
+        """ # pylint: disable=line-too-long
+        Dictionary with the public attributes of the pipeline, which from_dict turns into a
+        pipeline again
+
+        >>> sorted(Pipeline(['Raw'], language='en').to_dict().items())
+        [('cache_size', 0), ('hint_language', None), ('kwargs', {}), ('language', 'en'), ('max_workers', 1), ('steps', [('Raw', {})])]
         """
-        with open(filename, 'r') as json_file:
-            dict_representation = json.load(json_file)
-            return Pipeline.from_dict(dict_representation)
+        return {attr: getattr(self, attr) for attr in self.__slots__ if not attr.startswith('_')}
 
     @staticmethod
     def from_dict(dict_representation):
@@ -137,9 +462,8 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes,too-many-argumen
         dict_representation: A dictionary used to instantiate a pipeline object
         >>> d = {'steps': ['NSentences', ('CleanText', {'some': 'arg'})], 'language': 'it', 'hint_language': None, 'other': 'args'}
         >>> p = Pipeline.from_dict(d)
-        >>> public_flds = dict(filter(lambda i: not i[0].startswith('_'), p.__dict__.items()))
-        >>> sorted(public_flds.items())
-        [('hint_language', None), ('kwargs', {'other': 'args'}), ('language', 'it'), ('steps', [('NSentences', {}), ('CleanText', {'some': 'arg'})])]
+        >>> sorted(p.to_dict().items())
+        [('cache_size', 0), ('hint_language', None), ('kwargs', {'other': 'args'}), ('language', 'it'), ('max_workers', 1), ('steps', [('NSentences', {}), ('CleanText', {'some': 'arg'})])]
         """
         kwargs = dict_representation.pop('kwargs', None)
         if kwargs:
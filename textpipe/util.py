@@ -1,13 +1,102 @@
 """
 Textpipe utils.
 """
-from functools import reduce
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from operator import attrgetter
+
+import cld2
+from datasketch import MinHash
+
+# texts shorter than this are assumed to be in the hint language
+MIN_LANGUAGE_DETECTION_LENGTH = 10
+
+# number of detected languages that are cached, see detect_language
+LANGUAGE_CACHE_SIZE = 65536
+
+# (hash, length, hint_language) of a text -> (is_reliable, language)
+_DETECTED_LANGUAGES = OrderedDict()
+
+
+@lru_cache(maxsize=1024)
+def _attrgetter(field):
+    """attrgetter for a (dotted) field, which parses the field once"""
+    return attrgetter(field)
 
 
 def getattr_(obj, field):
     """Nested getattr"""
     try:
-        flist = field.split('.')
-        return reduce(getattr, flist, obj)
+        return _attrgetter(field)(obj)
     except AttributeError:
         return None
+
+
+def cached_method(method):
+    """
+    Memoize a method per instance. Unlike functools.lru_cache, which holds on to every instance
+    it has seen, the cache is stored on the instance itself and is freed along with it.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = vars(self).setdefault('_method_cache', {})
+        key = (method.__name__, args, frozenset(kwargs.items()))
+        if key not in cache:
+            cache[key] = method(self, *args, **kwargs)
+        return cache[key]
+    return wrapper
+
+
+def detect_language(text, hint_language=None):
+    """
+    Detects the language of a text with cld2. Cached on module level, so that docs with the
+    same content (e.g. duplicates in a batch) share a single detection. The cache is keyed by
+    the hash and length of the text rather than the text itself, so it doesn't keep texts alive.
+    """
+    key = (hash(text), len(text), hint_language)
+    try:
+        return _DETECTED_LANGUAGES[key]
+    except KeyError:
+        pass
+
+    detected = _detect_language_uncached(text, hint_language)
+    if len(_DETECTED_LANGUAGES) >= LANGUAGE_CACHE_SIZE:
+        try:
+            _DETECTED_LANGUAGES.popitem(last=False)  # evict the oldest entry
+        except KeyError:  # emptied by another thread
+            pass
+    _DETECTED_LANGUAGES[key] = detected
+    return detected
+
+
+def _detect_language_uncached(text, hint_language=None):
+    """
+    Detects the language of a text with cld2
+    """
+    none_utf_chars_removed = ''.join([l for l in text
+                                      if unicodedata.category(l)[0] not in {'M', 'C'}])
+
+    # cld2 cannot say anything useful about text without letters or with only a few
+    # characters, so don't bother calling it
+    if not any(char.isalpha() for char in none_utf_chars_removed):
+        return False, 'un'
+    if hint_language and len(none_utf_chars_removed) < MIN_LANGUAGE_DETECTION_LENGTH:
+        return True, hint_language
+
+    is_reliable, _, best_guesses = cld2.detect(none_utf_chars_removed,
+                                               hintLanguage=hint_language,
+                                               bestEffort=True)
+
+    if not best_guesses or len(best_guesses[0]) != 4 or best_guesses[0][1] == 'un':
+        return False, 'un'
+
+    return is_reliable, best_guesses[0][1]
+
+
+@lru_cache()
+def minhash_permutations(num_perm):
+    """
+    The random permutations datasketch draws for every new MinHash, computed once per num_perm.
+    """
+    return MinHash(num_perm=num_perm).permutations
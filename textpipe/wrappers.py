@@ -2,16 +2,34 @@
 Wrappers around classes of external libraries used in Doc class.
 """
 
-import pickle
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from urllib.parse import urlparse
 
 import numpy as np
 from gensim.models.keyedvectors import KeyedVectors
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
 from redis.exceptions import RedisError
 from tqdm import tqdm
 
+# number of word vectors sent to redis at once by load_keyed_vectors_into_redis
+LOAD_BATCH_SIZE = 1000
+
+# latest redis client by (host, port, database), through which the shared caches read
+_REDIS_CLIENTS = {}
+
+# caches of the raw word vectors of a model, shared by the RedisKeyedVectors of that model and
+# keyed by (host, port, database, key)
+_WORD_VEC_CACHES = {}
+
+
+def _get_word_vec_entry(model_location, word):
+    """
+    The raw bytes of the vector of a word, None if the word is not in redis
+    """
+    host, port, database, key = model_location
+    return _REDIS_CLIENTS[host, port, database].hget(key, word)
+
 
 class RedisKeyedVectorException(Exception):
     """ Raised when RedisKeyedVectors class fails"""
@@ -24,55 +42,136 @@ class RedisKeyedVectors:
     Based on https://engineering.talentpair.com/serving-word-vectors-
     for-distributed-computations-c5065cbaa02f
     """
+    __slots__ = ('key', 'idf_weighting', '_dim_key', '_dim', '_redis', '_cached_entry')
 
     def __init__(self, uri, key='', max_lru_cache_size=1024, idf_weighting='naive'):
-        self.word_vec = lru_cache(maxsize=max_lru_cache_size)(self.word_vec)
         self.key = f'w2v_{key}'
         self.idf_weighting = idf_weighting
+        # the dimension of the vectors is stored next to them, to check their size when reading.
+        # Unlike the keys of models, it doesn't start with 'w2v_', so the two can't collide
+        self._dim_key = f'w2v:dim:{key}'
+        self._dim = None
 
         try:
             host, port, database = self._parse_uri(uri)
-            self._redis = Redis(host, port, database)
+            # the client takes a connection from its pool per concurrent request, so threads
+            # don't wait on each other's sockets. The size of the pool can be set in the uri,
+            # e.g. redis://localhost:6379/0?max_connections=32, when all its connections are in
+            # use requests wait for a free one
+            pool = BlockingConnectionPool.from_url(uri, socket_keepalive=True)
+            self._redis = Redis(connection_pool=pool)
         except RedisError as exception:
             # pylint: disable=raise-missing-from
             raise RedisKeyedVectorException(f'The connection to Redis failed while trying to '
                                             f'initiate the client. Redis error message: '
                                             f'{exception}')
 
-    def word_vec(self, word):  # pylint: disable=E0202
+        # instances for the same model share a cache, of the size the first one asks for. It
+        # holds raw vectors, which every instance reads with the dimension it knows
+        _REDIS_CLIENTS[host, port, database] = self._redis
+        model_location = (host, port, database, self.key)
+        self._cached_entry = _WORD_VEC_CACHES.setdefault(
+            model_location,
+            lru_cache(maxsize=max_lru_cache_size)(partial(_get_word_vec_entry, model_location)))
+
+    def word_vec(self, word):
         """
         This method is mimicking the word_vec method from the Gensim KeyedVector class. Instead of
         looking it up from an in memory dict, it
         - requests the value from the redis instance, where the key is a combination between
         an optional word vector model key and the word itself
-        - decompresses it
-        - and finally unpickles it
+        - and reads the float32 vector from its raw bytes (without copying them, so the returned
+        array is read-only) after checking their size against the dimension of the model
 
         :param word: string
 
-        :returns: numpy array of dim of the word vector model (for Google: 300, 1)
+        :returns: numpy array of dim of the word vector model (for Google: 300, 1), or None if
+        the word is not in redis (misses are cached as well)
         """
-
         try:
-            cache_entry = self._redis.hget(self.key, word)
-            if not cache_entry:
-                raise KeyError(f'Key {word} does not exist in cache')
-            return pickle.loads(cache_entry)
+            cache_entry = self._cached_entry(word)
         except RedisError as exception:
             # pylint: disable=raise-missing-from
             raise RedisKeyedVectorException(f'The connection to Redis failed while trying to '
                                             f'retrieve a word vector. Redis error message: '
                                             f'{exception}')
-        except TypeError:
+        if cache_entry is None:
             return None
+        return self._to_vector(cache_entry)
 
     def __getitem__(self, words):
         """
-        Returns numpy array for single word or vstack for multiple words
+        Returns numpy array for single word or a (nr of words, dim) array for multiple words, the
+        vectors of multiple words are retrieved from redis in a single request and written into a
+        pre-allocated array
         """
         if isinstance(words, str):
             return self.word_vec(words)
-        return np.vstack([self.word_vec(word) for word in words])
+
+        words = list(words)
+        vectors = np.empty((len(words), self.dim), dtype=np.float32)
+        for i, (word, cache_entry) in enumerate(zip(words, self._get_entries(words))):
+            if cache_entry is None:
+                raise KeyError(f'Key {word} does not exist in cache')
+            self._check_size(cache_entry)
+            vectors[i] = np.frombuffer(cache_entry, dtype=np.float32)
+        return vectors
+
+    def get_vectors(self, words):
+        """
+        Returns the vectors of a list of words, retrieved from redis in a single request, with
+        None for the words that are not in redis
+        """
+        return [None if cache_entry is None else self._to_vector(cache_entry)
+                for cache_entry in self._get_entries(words)]
+
+    def _get_entries(self, words):
+        """
+        The raw vectors of a list of words in a single request, None for words not in redis
+        """
+        if not words:
+            return []  # redis doesn't accept an HMGET without fields
+        try:
+            return self._redis.hmget(self.key, words)
+        except RedisError as exception:
+            # pylint: disable=raise-missing-from
+            raise RedisKeyedVectorException(f'The connection to Redis failed while trying to '
+                                            f'retrieve word vectors. Redis error message: '
+                                            f'{exception}')
+
+    def _to_vector(self, data):
+        """
+        Reads a float32 vector from its raw bytes
+        """
+        self._check_size(data)
+        return np.frombuffer(data, dtype=np.float32)
+
+    def _check_size(self, data):
+        if len(data) != self.dim * 4:
+            raise RedisKeyedVectorException(f'The word vectors in {self.key} do not have the '
+                                            f'stored dimension {self.dim}; load the model again '
+                                            f'(see load_keyed_vectors_into_redis)')
+
+    @property
+    def dim(self):
+        """
+        The dimension of the word vectors, which is stored when the model is loaded into redis
+        """
+        if self._dim is None:
+            try:
+                dim = self._redis.get(self._dim_key)
+            except RedisError as exception:
+                # pylint: disable=raise-missing-from
+                raise RedisKeyedVectorException(f'The connection to Redis failed while trying to '
+                                                f'retrieve the dimension of the word vectors. '
+                                                f'Redis error message: {exception}')
+            if dim is None:
+                raise RedisKeyedVectorException(f'The dimension of the word vectors in {self.key} '
+                                                f'is not stored; they were loaded by an earlier '
+                                                f'version of textpipe, load the model again (see '
+                                                f'load_keyed_vectors_into_redis)')
+            self._dim = int(dim)
+        return self._dim
 
     def __contains__(self, word):
         """
@@ -80,31 +179,73 @@ class RedisKeyedVectors:
         """
         return self._redis.hexists(self.key, word)
 
-    def load_keyed_vectors_into_redis(self, model_path, idf_weighting='naive'):
+    def load_keyed_vectors_into_redis(self, model_path, idf_weighting='naive', max_workers=4):
         """
         This function loops over all available words in the loaded word2vec keyed vectors model
-        and loads them into the redis instance.
+        and loads them into the redis instance. The vectors are stored as the raw bytes of float32
+        arrays and sent in batches of LOAD_BATCH_SIZE by max_workers threads, so that serializing
+        the vectors overlaps with sending them to redis.
         """
         model = KeyedVectors.load(model_path, mmap='r')
-        nr_train_tokens = sum(token_vocab.count for token_vocab in model.vocab.values())
         self.idf_weighting = idf_weighting
         try:
-            for word in tqdm(list(model.vocab.keys())):
-                if self.idf_weighting == 'naive':
-                    idf = model.vocab[word].count
-                elif self.idf_weighting == 'log':
-                    idf = np.log(nr_train_tokens / (model.vocab[word].count + 1)) + 1
-                else:
-                    raise ValueError(f'idf_weighting "{self.idf_weighting}" not available; use '
-                                     f'"naive" or "log"')
-                idf_normalized_vector = model[word] / idf
-                self._redis.hset(self.key, word, pickle.dumps(idf_normalized_vector))
+            self._store_batches(self._serialized_batches(model), max_workers)
+            self._redis.set(self._dim_key, model.vector_size)
+            self._dim = model.vector_size
+            self._cached_entry.cache_clear()
         except RedisError as exception:
             # pylint: disable=raise-missing-from
             raise RedisKeyedVectorException(f'RedisError while trying to load model {model} '
                                             f'into redis: {exception}')
         del model
 
+    def _serialized_batches(self, model):
+        """
+        Yields dicts of LOAD_BATCH_SIZE words and the bytes of their idf normalized vectors
+        """
+        nr_train_tokens = sum(token_vocab.count for token_vocab in model.vocab.values())
+        # rows are read from the memory mapped vectors one at a time
+        vectors = model.vectors
+        batch = {}
+        for word, token_vocab in tqdm(model.vocab.items(), total=len(model.vocab)):
+            if self.idf_weighting == 'naive':
+                idf = token_vocab.count
+            elif self.idf_weighting == 'log':
+                idf = np.log(nr_train_tokens / (token_vocab.count + 1)) + 1
+            else:
+                raise ValueError(f'idf_weighting "{self.idf_weighting}" not available; '
+                                 f'use "naive" or "log"')
+            batch[word] = (vectors[token_vocab.index] / idf).astype(np.float32).tobytes()
+            if len(batch) == LOAD_BATCH_SIZE:
+                yield batch
+                batch = {}
+        if batch:
+            yield batch
+
+    def _store_batches(self, batches, max_workers):
+        """
+        Stores batches of serialized vectors with max_workers threads, so that serializing the
+        next batches overlaps with sending the previous ones to redis
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = []
+            for batch in batches:
+                pending.append(executor.submit(self._store_vectors, batch))
+                # bound the number of serialized batches waiting to be sent
+                if len(pending) > 2 * max_workers:
+                    pending.pop(0).result()
+            for future in pending:
+                future.result()
+
+    def _store_vectors(self, vectors):
+        """
+        Stores a dict of words and their serialized vectors in redis in a single round trip
+        """
+        redis_pipeline = self._redis.pipeline(transaction=False)
+        for word, vector in vectors.items():
+            redis_pipeline.hset(self.key, word, vector)
+        redis_pipeline.execute()
+
     @property
     def exists(self):
         """